@@ -59,26 +59,34 @@
 
 import os
 import sys
-import gpxpy
-import gpxpy.gpx
 from datetime import datetime, timedelta, timezone
 import piexif
-import pyheif
-import xml.etree.ElementTree as ET
-from math import radians, sin, cos, sqrt, atan2, degrees
+import pillow_heif
+from lxml import etree as ET
 import glob
 import zipfile
 import svgwrite
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFont, ExifTags
 import io
+import shutil
+import struct
 import datetime
-import pytz
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, lru_cache
+from xml.sax.saxutils import escape
+from array import array
+import numpy as np
+
+
+# Let Pillow open HEIC files
+pillow_heif.register_heif_opener()
 
 
 #
 # Change this to the proper offset based on where the gpx track was recorded and the photos taken
 #
 LOCAL_TIME_OFFSET_FROM_UTC = timedelta(hours=5, minutes=45)
+LOCAL_TIMEZONE = timezone(LOCAL_TIME_OFFSET_FROM_UTC)
 
 #
 # Duration for showing each photo
@@ -102,6 +110,51 @@ CAMERA_TILT_ANGLE=60
 #
 CAMERA_RANGE=1000
 
+#
+# Photos larger than this many pixels on the longer side are scaled down to this size before
+# they are put in the KMZ file.  Google Earth Pro doesn't show the photos any larger than the
+# screen and big photos make the KMZ file huge.
+#
+MAX_PHOTO_SIZE_IN_PIXELS=3840
+
+#
+# If this is more than 0, the line of the track is simplified before the tour is created.
+# Trackpoints that are less than this many metres off the simplified line don't get a line
+# segment of their own, so that clusters of trackpoints only a few metres apart don't each
+# add an update to the tour.  This makes the KMZ file smaller.  The tour still plays at the
+# same pace - the camera, the text images and the pauses still follow all the trackpoints.
+#
+TRACK_SIMPLIFICATION_TOLERANCE_IN_METRES=0
+
+#
+# The kml file inside the KMZ file is written without any indentation.  Set this to True to
+# also save an indented copy of it in the folder, which is easier to read when troubleshooting.
+#
+SAVE_INDENTED_KML_COPY=False
+
+#
+# Font used for the text images that show the track details during the tour.  It is loaded
+# only once by get_text_font() and shared by all the text images.
+#
+TEXT_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"  # Update if needed
+TEXT_FONT_SIZE = 40
+
+#
+# Icons for the waypoints.  A waypoint with <sym>Hotel</sym> is shown with Hotel.png.
+#
+ICON_NAMES = ["Hiker", "Heliport", "Hotel", "Restaurant", "Summit", "Bridge", "Airport"]
+
+#
+# Sub folder where the scaled down copies of the large jpeg photos are saved.
+#
+DOWNSCALED_PHOTOS_FOLDER_NAME = "downscaled_photos"
+
+#
+# Namespaces used in the kml file
+#
+KML_NAMESPACE = "http://www.opengis.net/kml/2.2"
+GX_NAMESPACE = "http://www.google.com/kml/ext/2.2"
+
 
 
 
@@ -134,116 +187,232 @@ def convert_to_local_time_string(utc_time):
         print("Error: Input must be a datetime.datetime object.")
         return None
 
-    # Ensure the input datetime is timezone-aware and in UTC.
-    if utc_time.tzinfo is None or utc_time.tzinfo != timezone.utc:
+    # Ensure the input datetime is timezone-aware.  Times without a timezone are in UTC.
+    if utc_time.tzinfo is None:
         utc_time = utc_time.replace(tzinfo=timezone.utc)
 
     # Convert the UTC time to local time
-    local_time = utc_time + LOCAL_TIME_OFFSET_FROM_UTC
+    local_time = utc_time.astimezone(LOCAL_TIMEZONE)
 
     # Format the local time as a string, excluding timezone info
     local_time_str = local_time.strftime('%Y-%m-%d %H:%M:%S')
     return local_time_str
 
-        
+
+UNIX_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Stored for trackpoints without a time.  This is NaT in a datetime64 array.
+NOT_A_TIME = np.iinfo(np.int64).min
+
+#
+# Converts a UTC datetime object to the number of microseconds since the unix epoch.
+# Unlike float seconds from timestamp(), these compare exactly the same as the
+# datetime objects themselves.  Times without a timezone are in UTC.
+#
+def to_epoch_microseconds(utc_time):
+    if utc_time.tzinfo is None:
+        utc_time = utc_time.replace(tzinfo=timezone.utc)
+    return (utc_time - UNIX_EPOCH) // timedelta(microseconds=1)
+
+
+#
+# Only the EXIF data and the size of a jpeg image are needed.  Both are in the segments
+# at the start of the file, so walk through those segments and stop before the compressed
+# image data instead of handing the whole file to PIL.
+#
+def read_jpeg_headers(filepath):
+    """
+    Reads the raw EXIF data and the size of a jpeg image without decoding the image.
+
+    Args:
+        filepath: The path to the jpeg file.
+
+    Returns:
+        A tuple (exif_bytes, width, height).  exif_bytes starts with "Exif\\0\\0"
+        and can be passed to piexif.load().
+    """
+    exif_bytes = None
+    width = height = None
+
+    with open(filepath, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError(f"Not a jpeg file: {filepath}")
+
+        while exif_bytes is None or width is None:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                break
+            while marker[1] == 0xFF:
+                # Skip fill bytes between segments
+                marker = marker[1:] + f.read(1)
+            code = marker[1]
+
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
+                # Markers without a length or payload
+                continue
+            if code in (0xD9, 0xDA):
+                # End of image or start of the compressed image data
+                break
+
+            length = struct.unpack('>H', f.read(2))[0]
+            if code == 0xE1 and exif_bytes is None:
+                data = f.read(length - 2)
+                if data.startswith(b'Exif\x00\x00'):
+                    exif_bytes = data
+            elif 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                # Start of frame - precision (1 byte), height (2 bytes), width (2 bytes)
+                data = f.read(length - 2)
+                height, width = struct.unpack('>HH', data[1:5])
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+    if exif_bytes is None:
+        raise ValueError(f"No EXIF data found in {filepath}")
+    if width is None:
+        raise ValueError(f"No image size found in {filepath}")
+
+    return exif_bytes, width, height
+
+
+#
+# Returns the info of the image and, for HEIC files, the opened HEIC file so that
+# it can be converted to jpeg without reading it again.
+#
 def get_image_info(filepath, filename):
+    heic_img = None
     ext = filepath.lower().split('.')[-1]
     if ext in ['jpg', 'jpeg']:
-        img = Image.open(filepath)
-        exif_data = piexif.load(img.info['exif'])
+        exif_bytes, width, height = read_jpeg_headers(filepath)
+        exif_data = piexif.load(exif_bytes)
         dt_str = exif_data['0th'][piexif.ImageIFD.DateTime].decode()
         dt = datetime.datetime.strptime(dt_str, "%Y:%m:%d %H:%M:%S")
         orientation = exif_data["0th"].get(piexif.ImageIFD.Orientation, "Not found")
-        width, height = img.size
-        #bbox = img.getbbox()
-        #print(f"image:{filename} size:{width}x{height}")
-        #print("Image bounding box (non-transparent content):", bbox)
     elif ext == 'heic':
-        heif_file = pyheif.read(filepath)
-        width = heif_file.size[0]
-        height = heif_file.size[1]
-
-        for metadata in heif_file.metadata or []:
-            if metadata['type'] == 'Exif':
-                exif_dict = piexif.load(metadata['data'])
-                dt_str = exif_dict['0th'][piexif.ImageIFD.DateTime].decode()
-                dt = datetime.datetime.strptime(dt_str, "%Y:%m:%d %H:%M:%S")
-                #print (f"datetime: {dt}")
-                
-                exif_dict = piexif.load(metadata['data'][6:])  # Skip "Exif\0\0"
-                orientation = exif_dict["0th"].get(piexif.ImageIFD.Orientation, "Not found")
-                break
-        else:
+        # Only the size and metadata are needed here.  Pillow decodes the image itself
+        # only once, later, when it is converted to jpeg.
+        heic_img = Image.open(filepath)
+        width, height = heic_img.size
+
+        exif = heic_img.getexif()
+        dt_str = exif.get(ExifTags.Base.DateTime)
+        if not dt_str:
             raise ValueError(f"No EXIF DateTime found in {filepath}")
+        dt = datetime.datetime.strptime(dt_str, "%Y:%m:%d %H:%M:%S")
+        #print (f"datetime: {dt}")
+
+        orientation = exif.get(ExifTags.Base.Orientation, "Not found")
     else:
         raise ValueError(f"Unsupported image format: {filepath}")
         
-    image_info = {"filename":filename, "filepath":filepath, "timestamp":(dt - LOCAL_TIME_OFFSET_FROM_UTC).replace(tzinfo=timezone.utc), "width":width, "height":height, "orientation":orientation}
+    image_info = {"filename":filename, "filepath":filepath, "timestamp":dt.replace(tzinfo=LOCAL_TIMEZONE).astimezone(timezone.utc), "width":width, "height":height, "orientation":orientation}
     #print(f"image_info: {image_info}")
-    return image_info
+    return image_info, heic_img
+
 
+#
+# Converts the HEIC file to jpeg.  Large photos are scaled down while converting.
+# Returns the size of the jpeg image.
+#
+def convert_heic_to_jpg(heic_img, jpg_path):
+    with heic_img:
+        img = heic_img.convert("RGB")
 
-def convert_heic_to_jpg(heic_path, jpg_path):
-    heic_img = pyheif.read(heic_path)
+    img.thumbnail((MAX_PHOTO_SIZE_IN_PIXELS, MAX_PHOTO_SIZE_IN_PIXELS), Image.Resampling.LANCZOS)
+    img.save(jpg_path, "JPEG", quality=85)
+    return img.size
 
-    img = Image.frombytes(
-        heic_img.mode, 
-        heic_img.size, 
-        heic_img.data, 
-        "raw"
-    )
-    
-    img.save(jpg_path, "JPEG")
-        
 
-def file_exists_case_insensitive(target_path):
-    folder = os.path.dirname(target_path)
-    target_file = os.path.basename(target_path).lower()
+#
+# Saves a copy of a jpeg photo that is scaled down to fit in MAX_PHOTO_SIZE_IN_PIXELS.
+# Returns the size of the scaled down image.
+#
+def create_downscaled_jpg(jpg_path, downscaled_jpg_path):
+    with Image.open(jpg_path) as img:
+        width, height = img.size
+        scale = MAX_PHOTO_SIZE_IN_PIXELS / max(width, height)
+
+        # Let the jpeg decoder do as much of the scaling as it can.  This is a lot faster
+        # than decoding the photo at full size.
+        img.draft("RGB", (int(width * scale), int(height * scale)))
 
+        img.thumbnail((MAX_PHOTO_SIZE_IN_PIXELS, MAX_PHOTO_SIZE_IN_PIXELS), Image.Resampling.LANCZOS)
+        img.save(downscaled_jpg_path, "JPEG", quality=85, optimize=True, progressive=True)
+        return img.size
+        
+
+#
+# Get the info of a single image file.  HEIC files are converted to jpeg here as well.
+# filenames_lower is the set of lowercased names of all the files in the folder.
+# Returns None if the file should be skipped.
+#
+def process_image_file(folder, filenames_lower, filename):
+    filepath = os.path.join(folder, filename)
     try:
-        return any(f.lower() == target_file for f in os.listdir(folder))
-    except FileNotFoundError:
-        return False
+        if filename.lower().endswith(('.jpeg')):
+            #print (f"filename: {filename}")
+            base_name_img = os.path.splitext(os.path.basename(filepath))[0]
+            equivalent_heic_filename = f"{base_name_img}.heic"
+            #print (f"equivalent_heic_filename: {equivalent_heic_filename}")
+            if equivalent_heic_filename.lower() in filenames_lower:
+                return None
         
-    
+        info, heic_img = get_image_info(filepath, filename)
+        
+        #
+        # Google Earth Pro doesnt display HEIC files.  Hence convert them to jpeg and store
+        # the name and path of the jpeg file
+        #
+        if filename.lower().endswith(('.heic')):
+            #print ("Convert HEIC to jpeg")
+            base_name_img = os.path.splitext(os.path.basename(info["filepath"]))[0]
+            new_jpeg_filename = f"{base_name_img}.jpeg"
+            new_jpeg_filepath = os.path.join(folder, new_jpeg_filename)
+            info["width"], info["height"] = convert_heic_to_jpg(heic_img, new_jpeg_filepath)
+            info["filename"] = new_jpeg_filename
+            info["filepath"] = new_jpeg_filepath
+            #
+            # When the heic image is converted, its orientation is fixed in the jpeg version.
+            # Hence ignore the orientation data from the heic file.
+            #
+            info["orientation"] = 1
+        elif max(info["width"], info["height"]) > MAX_PHOTO_SIZE_IN_PIXELS:
+            #
+            # Put a scaled down copy of a large jpeg photo in the KMZ file instead of the
+            # original.  The copy has the same name so that it is stored in the KMZ under
+            # the same name.  The orientation from the original still applies to it.
+            #
+            downscaled_folder = os.path.join(folder, DOWNSCALED_PHOTOS_FOLDER_NAME)
+            os.makedirs(downscaled_folder, exist_ok=True)
+            downscaled_filepath = os.path.join(downscaled_folder, filename)
+            info["width"], info["height"] = create_downscaled_jpg(filepath, downscaled_filepath)
+            info["filepath"] = downscaled_filepath
+
+        # Id of the ScreenOverlay of the photo in the kml file
+        info["overlay_id"] = f"image_{os.path.splitext(info["filename"])[0]}"
+        
+        return info
+    except Exception as e:
+        print(f"Warning: Skipping {filename}: {e}")
+        return None
+
+
+#
+# The image files are independent of each other, so read them (and convert the HEIC
+# files) in parallel using all the cores.
+#
 def get_info_of_all_images_files(folder):
-    local_photo_images_info = []
-    for filename in os.listdir(folder):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.heic')):
-            filepath = os.path.join(folder, filename)
-            try:
-                if filename.lower().endswith(('.jpeg')):
-                    #print (f"filename: {filename}")
-                    base_name_img = os.path.splitext(os.path.basename(filepath))[0]
-                    equivalent_heic_filename = f"{base_name_img}.heic"
-                    equivalent_heic_filepath = os.path.join(folder, equivalent_heic_filename)
-                    #print (f"equivalent_heic_filename: {equivalent_heic_filename}   equivalent_heic_filepath:{equivalent_heic_filepath}")
-                    if file_exists_case_insensitive(equivalent_heic_filepath):
-                        continue
-                
-                info = get_image_info(filepath, filename)
-                
-                #
-                # Google Earth Pro doesnt display HEIC files.  Hence convert them to jpeg and store
-                # the name and path of the jpeg file
-                #
-                if filename.lower().endswith(('.heic')):
-                    #print ("Convert HEIC to jpeg")
-                    base_name_img = os.path.splitext(os.path.basename(info["filepath"]))[0]
-                    new_jpeg_filename = f"{base_name_img}.jpeg"
-                    new_jpeg_filepath = os.path.join(folder, new_jpeg_filename)
-                    convert_heic_to_jpg(filepath, new_jpeg_filepath)
-                    info["filename"] = new_jpeg_filename
-                    info["filepath"] = new_jpeg_filepath
-                    #
-                    # When the heic image is converted, its orientation is fixed in the jpeg version.
-                    # Hence ignore the orientation data from the heic file.
-                    #
-                    info["orientation"] = 1
-                
-                local_photo_images_info.append(info)
-            except Exception as e:
-                print(f"Warning: Skipping {filename}: {e}")
+    #
+    # Read the folder only once.  The lowercased names are used to check whether a jpeg
+    # file has a HEIC equivalent.
+    #
+    entries = list(os.scandir(folder))
+    filenames_lower = {entry.name.lower() for entry in entries}
+    filenames = [entry.name for entry in entries if entry.is_file() and entry.name.lower().endswith(('.jpg', '.jpeg', '.heic'))]
+
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(partial(process_image_file, folder, filenames_lower), filenames)
+        local_photo_images_info = [info for info in results if info is not None]
+
     return sorted(local_photo_images_info, key=lambda info: info["filename"])
 
 
@@ -259,8 +428,7 @@ def create_photo_image_overlay_element(info):
     Returns:
         ET.Element: The created <ScreenOverlay> element.
     """
-    base_name_img = os.path.splitext(os.path.basename(info["filepath"]))[0]
-    overlay_id = f"image_{base_name_img}"
+    overlay_id = info["overlay_id"]
     
     screen_overlay = ET.Element("ScreenOverlay", attrib={"id": overlay_id})
     ET.SubElement(screen_overlay, "name").text = f"ImageOverlay_{overlay_id}"
@@ -340,73 +508,128 @@ def create_text_image_overlay_element(text_image_path, overlay_id):
     return screen_overlay
     
     
-def calculate_bearing(points, current_index, points_to_consider=100):
+def calculate_bearings(lats_rad, lons_rad, points_to_consider=100):
     """
-    Calculates the bearing from the current track point to a point
-    further along the track.
+    Calculates the bearing from every track point to a point further
+    along the track.
 
     Args:
-        points: A list of tuples, where each tuple contains coordinate data.
-                The order of elements in the tuple is (longitude, latitude, ...).
-        current_index: The index of the starting track point.
+        lats_rad: A NumPy array of the latitudes of the track points in radians.
+        lons_rad: A NumPy array of the longitudes of the track points in radians.
         points_to_consider: The number of subsequent track points to consider
                             as the end point for bearing calculation (default is 100).
 
     Returns:
-        The bearing in degrees (0-360) from the current point to the
-        point `points_to_consider` steps ahead, or None if there are
-        fewer than 2 points within the specified range.
+        A NumPy array with the bearing in degrees (0-360) from each point to the
+        point `points_to_consider` steps ahead.  Near the end of the track, the
+        last track point is used as the end point instead.
     """
-    num_points = len(points)
+    num_points = len(lats_rad)
+    end_indices = np.minimum(np.arange(num_points) + points_to_consider, num_points - 1)
 
-    if current_index >= num_points - 1:
-        return None
+    lat1 = lats_rad
+    lat2 = lats_rad[end_indices]
+    dLon = lons_rad[end_indices] - lons_rad
 
-    end_index = min(current_index + points_to_consider, num_points - 1)
+    y = np.sin(dLon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dLon)
 
-    if end_index <= current_index:
-        return None
+    bearings_deg = (np.degrees(np.arctan2(y, x)) + 360) % 360
+    return bearings_deg
 
-    lon1_deg = points[current_index]["longitude"]
-    lat1_deg = points[current_index]["latitude"]
-    lon2_deg = points[end_index]["longitude"]
-    lat2_deg = points[end_index]["latitude"]
 
-    lon1 = radians(float(lon1_deg))
-    lat1 = radians(float(lat1_deg))
-    lon2 = radians(float(lon2_deg))
-    lat2 = radians(float(lat2_deg))
+def calculate_segment_distances(lats_rad, lons_rad):
+    """
+    Calculates the distance in meters between every pair of consecutive track points
+    in a single vectorized pass.  Uses the Haversine formula for accuracy on a sphere.
+
+    Args:
+        lats_rad: A NumPy array of the latitudes of the track points in radians.
+        lons_rad: A NumPy array of the longitudes of the track points in radians.
+
+    Returns:
+        A NumPy array with one distance less than the number of track points.
+    """
+    R = 6371000  # Radius of the Earth in meters
+    dlon = np.diff(lons_rad)
+    dlat = np.diff(lats_rad)
 
-    dLon = lon2 - lon1
+    # The cosine of each latitude is used by the segments on both sides of the point
+    cos_lats = np.cos(lats_rad)
 
-    y = sin(dLon) * cos(lat2)
-    x = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dLon)
+    a = np.sin(dlat / 2)**2 + cos_lats[:-1] * cos_lats[1:] * np.sin(dlon / 2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
 
-    bearing_rad = atan2(y, x)
-    bearing_deg = (degrees(bearing_rad) + 360) % 360
-    return bearing_deg
+    distance = R * c
+    return distance
 
 
-def calculate_distance(lat1, lon1, lat2, lon2):
+def simplify_track(lats_rad, lons_rad, tolerance, keep_indices):
     """
-    Calculates the distance in meters between two GPS coordinates.
-    Uses the Haversine formula for accuracy on a sphere.
+    Simplifies the track with the Ramer-Douglas-Peucker algorithm.  Starting with the
+    line between the first and the last track points, the track point farthest off the
+    line is kept and the line is split there, until no track point is farther off the
+    line than the tolerance.
+
+    The track points are projected to metres on a plane at the mean latitude of the
+    track.  This is accurate enough for the short distances compared with the tolerance.
+
+    Args:
+        lats_rad: A NumPy array of the latitudes of the track points in radians.
+        lons_rad: A NumPy array of the longitudes of the track points in radians.
+        tolerance: The largest distance in meters a dropped track point can be off the
+                   simplified track.
+        keep_indices: Indices of the track points that are always kept, e.g. where a
+                      new track begins.
+
+    Returns:
+        A sorted NumPy array of the indices of the track points that are kept.  The
+        first and the last track points are always kept.
     """
     R = 6371000  # Radius of the Earth in meters
-    #print(f"lat1: {lat1} lon1: {lon1} lat2: {lat2} lon2: {lon2}")
-    lat1_rad = radians(lat1)
-    lon1_rad = radians(lon1)
-    lat2_rad = radians(lat2)
-    lon2_rad = radians(lon2)
+    xs = R * lons_rad * np.cos(np.mean(lats_rad))
+    ys = R * lats_rad
 
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
+    keep = np.zeros(len(lats_rad), dtype=bool)
+    keep[keep_indices] = True
+    keep[[0, -1]] = True
 
-    a = sin(dlat / 2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    # Simplify the track between each pair of the track points that are always kept
+    anchors = np.flatnonzero(keep)
+    stack = list(zip(anchors[:-1].tolist(), anchors[1:].tolist()))
+
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        dx, dy = xs[end] - xs[start], ys[end] - ys[start]
+        px, py = xs[start+1:end] - xs[start], ys[start+1:end] - ys[start]
+
+        # Distance of the track points in between from the line from start to end
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(dx * py - dy * px) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return np.flatnonzero(keep)
+
+#
+# Loads the font of the text images when the first text image is rendered, so the script
+# doesn't need the font just to start.  Each process loads it only once.
+#
+@lru_cache(maxsize=None)
+def get_text_font():
+    return ImageFont.truetype(TEXT_FONT_PATH, TEXT_FONT_SIZE)
 
-    distance = R * c
-    return distance
 
 #
 # This function create a transparent png image for each trackpoint.  The image will contain
@@ -416,8 +639,6 @@ def calculate_distance(lat1, lon1, lat2, lon2):
 #def create_text_image_png(text1, text2, text3, text4, filename):
 def create_text_image_png(text1, text2, filename):
     width, height = 1600, 300
-    font_size = 40
-    font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"  # Update if needed
 
 #    texts = [text1, text2, text3, text4]
     texts = [text1, text2]
@@ -425,194 +646,250 @@ def create_text_image_png(text1, text2, filename):
 #    base_y = 80
     base_y = 180
 
-    # Load font
-    font = ImageFont.truetype(font_path, font_size)
+    # The dark outline around the white text is drawn by Pillow's built-in text stroke.
+    # This is a single call per line instead of drawing a separate shadow for the text.
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
 
-    # --- STROKE VERSION ---
-    #img_stroke = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-    #draw_stroke = ImageDraw.Draw(img_stroke)
+    for i, txt in enumerate(texts):
+        y = base_y + i * line_spacing
+        x = 20
 
-    #for i, txt in enumerate(texts):
-    #    y = base_y + i * line_spacing
-    #    x = 50
-    #    # Draw stroke (outline)
-    #    for dx in [-2, 0, 2]:
-    #        for dy in [-2, 0, 2]:
-    #            if dx != 0 or dy != 0:
-    #                draw_stroke.text((x + dx, y + dy), txt, font=font, fill="black")
-    #    # Draw fill
-    #    draw_stroke.text((x, y), txt, font=font, fill="white")
+        draw.text((x, y), txt, font=get_text_font(), fill="white", stroke_width=2, stroke_fill=(0, 0, 0, 220))
 
-    #img_stroke.save(f"{filename}-stroke.png")
+    # These images are only shown once during the tour, so favour a fast save over a small file
+    img.save(f"{filename}", "PNG", optimize=False, compress_level=1)
 
-    # --- SHADOW VERSION ---
-    img_shadow = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-    draw_shadow = ImageDraw.Draw(img_shadow)
 
-    shadow_offset = (2, 2)
-    blur_radius = 2
 
-    for i, txt in enumerate(texts):
-        y = base_y + i * line_spacing
-        x = 20
 
-        # Create a temporary image for the shadow
-        tmp_img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-        tmp_draw = ImageDraw.Draw(tmp_img)
-        tmp_draw.text((x + shadow_offset[0], y + shadow_offset[1]), txt, font=font, fill="black")
+#
+# Escapes text for the kml file.  The result can be used both as the text of an element
+# and as an attribute value.  The same ids are written many times in the tour, so the
+# escaped strings are cached.
+#
+@lru_cache(maxsize=None)
+def escape_xml(text):
+    return escape(str(text), {'"': "&quot;"})
+
 
-        # Blur and paste
-        blurred = tmp_img.filter(ImageFilter.GaussianBlur(blur_radius))
-        img_shadow = Image.alpha_composite(img_shadow, blurred)
+#
+# Writes the kml document to a binary stream, e.g. a file opened inside the KMZ file.
+#
+# The tour playlist is written once and never read back, so there is no need to build
+# elements for it.  Its entries are written from the templates below that are already
+# in the final kml form.  The same is done for the line segments, the only features of
+# the document that there is one of for every trackpoint.  The other features of the
+# document are still built as lxml elements and written with write_element().
+#
+# The entries are small, so they are collected and written to the stream in blocks of
+# about BLOCK_SIZE bytes.  Call flush() after the last entry.
+#
+class KmlWriter:
+    BLOCK_SIZE = 64 * 1024
 
-        # Draw the white text on top
-        draw_shadow = ImageDraw.Draw(img_shadow)
-        draw_shadow.text((x, y), txt, font=font, fill="white")
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = []
+        self.pending_size = 0
 
-    img_shadow.save(f"{filename}")
+    def write(self, text):
+        # text must already be escaped
+        self.write_bytes(text.encode('utf-8'))
 
+    def write_element(self, element):
+        self.write_bytes(ET.tostring(element, encoding='utf-8'))
 
+    def write_bytes(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.stream.write(b''.join(self.pending))
+        self.pending = []
+        self.pending_size = 0
 
 
 #
-# The main function of the script
-#        
-def create_kmz_from_gpx_and_photos(folder):
+# Templates of the entries of the tour playlist
+#
+FLY_TO_TEMPLATE = (
+    '<gx:FlyTo><gx:duration>{duration}</gx:duration><gx:flyToMode>smooth</gx:flyToMode>'
+    '<LookAt><longitude>{longitude}</longitude><latitude>{latitude}</latitude><altitude>0</altitude>'
+    '<heading>{heading}</heading><tilt>{tilt}</tilt><range>{range}</range>'
+    '<altitudeMode>relativeToGround</altitudeMode></LookAt></gx:FlyTo>'
+)
+
+WAIT_TEMPLATE = '<gx:Wait><gx:duration>{duration}</gx:duration></gx:Wait>'
+
+SCREEN_OVERLAY_VISIBILITY_TEMPLATE = (
+    '<gx:AnimatedUpdate><Update><Change><ScreenOverlay targetId="{overlay_id}">'
+    '<visibility>{visibility}</visibility>'
+    '</ScreenOverlay></Change></Update></gx:AnimatedUpdate>'
+)
+
+PLACEMARK_VISIBILITY_TEMPLATE = (
+    '<gx:AnimatedUpdate><Update>{target_href}<Change><Placemark targetId="{placemark_id}">'
+    '<visibility>{visibility}</visibility></Placemark></Change></Update></gx:AnimatedUpdate>'
+)
+
+# Shows the next line segment and moves the Hiker icon in a single update
+TRACK_STEP_TEMPLATE = (
+    '<gx:AnimatedUpdate><Update><targetHref/><Change>'
+    '<Placemark targetId="seg{index}"><visibility>1</visibility></Placemark>'
+    '<Placemark targetId="Hiker">'
+    '<Point><coordinates>{coordinates}</coordinates></Point><visibility>1</visibility>'
+    '</Placemark></Change></Update></gx:AnimatedUpdate>'
+)
 
-    #
-    # Find the gpx file in the folder.  There should be only one gpx file.  Even if there are other gpx
-    # files, they will be ignored.  Get the data from the gpx file into gpx variable.
-    #
-    for file in os.listdir(folder):
-        # print(f"folder: {folder} file: {file}")
-        if file.lower().endswith('.gpx'):
-            gpx_file_name = file
-            with open(os.path.join(folder, file), 'r', encoding='utf-8') as gpx_file:
-                print(f"Found gpx file: {gpx_file.name}.  Converting it to kml and embedding photos and track details inside it...")
-                gpx = gpxpy.parse(gpx_file)
-                break
-                
-    if not 'gpx' in locals() or 'gpx' in globals():
-        print("No GPX file found in folder")
-        return
+#
+# Template of the placemark of a line segment.  These are hidden initially and are shown
+# one by one during the tour.
+#
+SEGMENT_PLACEMARK_TEMPLATE = (
+    '<Placemark id="seg{index}"><styleUrl>#track_style_{color}</styleUrl><visibility>0</visibility>'
+    '<LineString><tessellate>1</tessellate><coordinates>{coordinates}</coordinates></LineString></Placemark>'
+)
 
-    photo_images_info = get_info_of_all_images_files(folder)
+#
+# The parts of the playlist that are the same every time they are written are formatted
+# and encoded only once.
+#
+# FlyTo to follow the track.  Only the position and the heading are filled in each time.
+CAMERA_FLY_TO_TEMPLATE = FLY_TO_TEMPLATE.format(duration='.3', longitude='{longitude}', latitude='{latitude}',
+                                                heading='{heading}', tilt=CAMERA_TILT_ANGLE, range=CAMERA_RANGE)
+SEGMENT_PAUSE_ENTRY = WAIT_TEMPLATE.format(duration=PAUSE_BETWEEN_LINE_SEGMENTS_IN_SECS).encode('utf-8')
+PHOTO_DURATION_ENTRY = WAIT_TEMPLATE.format(duration=PHOTO_DURATION_TIME_IN_SECS).encode('utf-8')
 
-    #for info in photo_images_info:
-    #    print(f'filename: {info["filename"]}')
 
-      
-    default_color = 'FFFFFFFF'  # White 
-    points = []
-    
-    #
-    # Get the points data from the GPX file into points variable
-    #
-    for track in gpx.tracks:
-        # Get color from GPX track extensions.  Handles missing color.
-        track_color = default_color
-        if track.extensions:
-            for extension in track.extensions:
-                if extension.tag.endswith('line'):
-                    for sub_extension in extension:
-                        if sub_extension.tag.endswith('color') and sub_extension.text:
-                            track_color = sub_extension.text
-                            break  # Exit inner loop
-                    break  # Exit outer loop
-        for segment in track.segments:
-            for point in segment.points:
-                points.append( {"longitude":point.longitude, "latitude":point.latitude, "elevation":point.elevation or 0, "color":track_color, "time":point.time, "name":track.name} )
-
-    if len(points) < 2:
-        return  # Skip if not enough points to form a line
+def write_screen_overlay_visibility(kml, overlay_id, visibility):
+    """
+    Writes a gx:AnimatedUpdate that shows or hides a ScreenOverlay during the tour.
 
+    Args:
+        kml (KmlWriter): The writer of the kml file.
+        overlay_id (str): The id of the ScreenOverlay.
+        visibility (str): "1" to show the overlay and "0" to hide it.
+    """
+    kml.write(SCREEN_OVERLAY_VISIBILITY_TEMPLATE.format(overlay_id=escape_xml(overlay_id), visibility=visibility))
 
-    #
-    # Define the beginning of the kml doc
-    #
-    doc = ET.Element('kml', {
-        'xmlns': "http://www.opengis.net/kml/2.2",
-        'xmlns:gx': "http://www.google.com/kml/ext/2.2"
-    })
-    document = ET.SubElement(doc, 'Document')
-    ET.SubElement(document, 'name').text = gpx_file_name
-    
-    # gx:Tour
-    tour = ET.SubElement(document, 'gx:Tour')
-    ET.SubElement(tour, 'name').text = 'Animated tour'
-    playlist = ET.SubElement(tour, 'gx:Playlist')
-    
+
+def write_placemark_visibility(kml, placemark_id, visibility, target_href=False):
+    """
+    Writes a gx:AnimatedUpdate that shows or hides a Placemark during the tour.
+
+    Args:
+        kml (KmlWriter): The writer of the kml file.
+        placemark_id (str): The id of the Placemark.
+        visibility (str): "1" to show the placemark and "0" to hide it.
+        target_href (bool): Whether to write an empty targetHref in the Update.
+    """
+    kml.write(PLACEMARK_VISIBILITY_TEMPLATE.format(target_href='<targetHref/>' if target_href else '',
+                                                   placemark_id=escape_xml(placemark_id), visibility=visibility))
+
+
+def write_wait(kml, duration):
+    """
+    Writes a gx:Wait of the given duration.
+
+    Args:
+        kml (KmlWriter): The writer of the kml file.
+        duration: The duration of the wait in seconds.
+    """
+    kml.write(WAIT_TEMPLATE.format(duration=duration))
+
+
+def write_segment_pauses(kml, count):
+    """
+    Writes a single gx:Wait for the pauses after the given number of trackpoints.
+
+    Args:
+        kml (KmlWriter): The writer of the kml file.
+        count (int): The number of trackpoints to pause for.
+    """
+    if count == 1:
+        kml.write_bytes(SEGMENT_PAUSE_ENTRY)
+    else:
+        write_wait(kml, round(count * PAUSE_BETWEEN_LINE_SEGMENTS_IN_SECS, 6))
+
+
+def write_photo_display(kml, overlay_id):
+    """
+    Writes the playlist entries that show a photo for PHOTO_DURATION_TIME_IN_SECS
+    and then hide it again.
+
+    Args:
+        kml (KmlWriter): The writer of the kml file.
+        overlay_id (str): The id of the ScreenOverlay of the photo.
+    """
+    write_screen_overlay_visibility(kml, overlay_id, "1")
+    kml.write_bytes(PHOTO_DURATION_ENTRY)
+    write_screen_overlay_visibility(kml, overlay_id, "0")
+
+
+#
+# Write the playlist of the tour.  Each entry is written to the kml file as soon as it is
+# created instead of building the whole tour in memory first.
+#
+def write_tour_playlist(kml, title_exists, waypoints, points, segment_ends, bearings, photo_images_info):
     #
     # This is to show the globe with India at the center from 4000km range.
     #
-    flyto = ET.SubElement(playlist, 'gx:FlyTo')
-    ET.SubElement(flyto, 'gx:duration').text = '0'
-    ET.SubElement(flyto, 'gx:flyToMode').text = 'smooth'
-    lookat = ET.SubElement(flyto, 'LookAt')
-    ET.SubElement(lookat, 'longitude').text = '78.9629'
-    ET.SubElement(lookat, 'latitude').text = '20.5937'
-    ET.SubElement(lookat, 'altitude').text = '0'
-    ET.SubElement(lookat, 'heading').text = '0'
-    #ET.SubElement(lookat, 'heading').text = '0'
-    ET.SubElement(lookat, 'tilt').text = '0'
-    #ET.SubElement(lookat, 'tilt').text = '0'
-    ET.SubElement(lookat, 'range').text = '40000000'
-    ET.SubElement(lookat, 'altitudeMode').text = 'relativeToGround'            		
-            
+    kml.write(FLY_TO_TEMPLATE.format(duration='0', longitude='78.9629', latitude='20.5937',
+                                     heading='0', tilt='0', range='40000000'))
+
     #
     # This is to zoom to the starting point of the track.
     #
-    flyto = ET.SubElement(playlist, 'gx:FlyTo')
-    ET.SubElement(flyto, 'gx:duration').text = '5'
-    ET.SubElement(flyto, 'gx:flyToMode').text = 'smooth'
-    lookat = ET.SubElement(flyto, 'LookAt')
-    ET.SubElement(lookat, 'longitude').text = str(points[0]["longitude"])
-    ET.SubElement(lookat, 'latitude').text = str(points[0]["latitude"])
-    ET.SubElement(lookat, 'altitude').text = '0'
-    ET.SubElement(lookat, 'heading').text = '0'
-    #ET.SubElement(lookat, 'heading').text = '0'
-    ET.SubElement(lookat, 'tilt').text = '0'
-    #ET.SubElement(lookat, 'tilt').text = '0'
-    ET.SubElement(lookat, 'range').text = '1000'
-    ET.SubElement(lookat, 'altitudeMode').text = 'relativeToGround'            		
-
-    wait_element = ET.SubElement(playlist, "gx:Wait")
-    ET.SubElement(wait_element, "gx:duration").text = "1"
-    
+    kml.write(FLY_TO_TEMPLATE.format(duration='5', longitude=points["longitude"][0], latitude=points["latitude"][0],
+                                     heading='0', tilt='0', range='1000'))
+
+    write_wait(kml, "1")
+
     #
     # Hide the title after the camera has zoomed into the starting point of the track that should
     # have happened now.
     #
-    title_filepath = os.path.join(folder, "Title.png")
-    if os.path.exists(title_filepath):
-        animated_update_hide = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-        update_hide = ET.SubElement(animated_update_hide, "Update")
-        change_hide = ET.SubElement(update_hide, "Change")
-        screen_overlay_hide = ET.SubElement(change_hide, "ScreenOverlay", attrib={"targetId": "title_overlay"})
-        ET.SubElement(screen_overlay_hide, "visibility", attrib={"xmlns":"http://www.opengis.net/kml/2.2"}).text = "0"        
-
-    # Show all the waypoints encountered only on the ascent at the beginning of the tour
-    for i, waypoint in enumerate(gpx.waypoints):
-        animated_update_show = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-        update_show = ET.SubElement(animated_update_show, "Update")
-        ET.SubElement(update_show, 'targetHref')
-        change_show = ET.SubElement(update_show, "Change")
-        placemark_show = ET.SubElement(change_show, "Placemark", attrib={"targetId": f'waypoint{i}'})
-        ET.SubElement(placemark_show, "visibility").text = "1"
+    if title_exists:
+        write_screen_overlay_visibility(kml, "title_overlay", "0")
 
-        #
-        # There were only 13 way points on the ascent.
-        #
-        if i==12:
-            break
+    #
+    # Show all the waypoints encountered only on the ascent at the beginning of the tour.
+    # There were only 13 way points on the ascent.
+    #
+    for i in range(min(len(waypoints), 13)):
+        write_placemark_visibility(kml, f'waypoint{i}', "1", target_href=True)
 
-    # Change camera position every this number of points 
+    # Change camera position every this number of points
     update_camera_frequency = 100
 
     image_index = 0
     previous_text_image_overlay_id = ""
-    
-    #    
+    descent_started = False
+    pending_pauses = 0
+
+    #
+    # The columns are NumPy arrays.  Reading single items from them one at a time in the loop
+    # below is slower than from lists, so the loop reads them from lists of the same values.
+    #
+    longitudes, latitudes = points["longitude"].tolist(), points["latitude"].tolist()
+    times, names, coordinates = points["time"], points["name"], points["coordinates"]
+    bearings = bearings.tolist()
+
+    #
+    # For each trackpoint, find the number of photos that should have been shown by then with
+    # a single binary search over all the trackpoints.  The photos are sorted by name and not by
+    # time, so search the running maximum of their timestamps.  A photo is then shown only after
+    # all the photos before it, same as stepping through them one at a time.  The timestamps
+    # are compared as int64 microseconds since the epoch.
+    #
+    photo_timestamps = np.array([to_epoch_microseconds(info["timestamp"]) for info in photo_images_info], dtype=np.int64)
+    trackpoint_timestamps = times.astype(np.int64)
+    photo_end_indices = np.searchsorted(np.maximum.accumulate(photo_timestamps), trackpoint_timestamps, side='left').tolist()
+
+    #
     # Create animated elements
     # - Show all the photos between the previous trackpoint and the current trackpoint, each for 2 seconds
     # - Change the camera position
@@ -620,220 +897,165 @@ def create_kmz_from_gpx_and_photos(folder):
     # - Show the transparent png that has details of the track name, distance, elevation and time.  Before
     #   that hide the previous such image.
     #
-    for i in range(len(points) - 1):
-        # lon, lat, elevation, color, time, track_name = points[i]
-        lon, lat, elevation, color, time, track_name = (
-            points[i]["longitude"],
-            points[i]["latitude"],
-            points[i]["elevation"],
-            points[i]["color"],
-            points[i]["time"],
-            points[i]["name"]
-        )
-       
-        bearing = calculate_bearing(points, i, 50)
-        #print(f"image_index: {image_index}   len:{len(photo_images_info)}   photo_time:{photo_images_info[image_index]["timestamp"]}   time:{time}")
-    
+    # When the track is simplified, only some of the trackpoints start a line segment.  The
+    # pauses of the trackpoints in between are added up into a single wait, so the line still
+    # progresses at the same pace and the photos, the text images and the camera still change
+    # at the same trackpoints.
+    #
+    for i in range(len(times) - 1):
+        lon, lat, track_name = longitudes[i], latitudes[i], names[i]
+
+        bearing = bearings[i]
+
+        show_photos = photo_end_indices[i] > image_index
+        show_text_image = i==0 or i%10 == 0
+        move_camera = i%update_camera_frequency == 0
+        show_segment = i in segment_ends
+
+        # Pause for the trackpoints before this one before anything is changed at this trackpoint
+        if pending_pauses and (show_photos or show_text_image or move_camera or show_segment):
+            write_segment_pauses(kml, pending_pauses)
+            pending_pauses = 0
+
         # Show all photos before the current trackpoint apart from the ones already shown.
         # This also ensures that all the photos taken before the tracking had begun will be
-        # shown initially.        
-        while image_index < len(photo_images_info) and photo_images_info[image_index]["timestamp"] < time:
-            img_base_name = os.path.splitext(os.path.basename(photo_images_info[image_index]["filename"]))[0]
-            overlay_id = f"image_{img_base_name}"
-                
-            animated_update_show = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-            update_show = ET.SubElement(animated_update_show, "Update")
-            change_show = ET.SubElement(update_show, "Change")
-            screen_overlay_show = ET.SubElement(change_show, "ScreenOverlay", attrib={"targetId": overlay_id})
-            ET.SubElement(screen_overlay_show, "visibility", attrib={"xmlns": "http://www.opengis.net/kml/2.2"}).text = "1"
-
-            wait_element = ET.SubElement(playlist, "gx:Wait")
-            ET.SubElement(wait_element, "gx:duration").text = str(PHOTO_DURATION_TIME_IN_SECS)
-
-            animated_update_hide = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-            update_hide = ET.SubElement(animated_update_hide, "Update")
-            change_hide = ET.SubElement(update_hide, "Change")
-            screen_overlay_hide = ET.SubElement(change_hide, "ScreenOverlay", attrib={"targetId": overlay_id})
-            ET.SubElement(screen_overlay_hide, "visibility", attrib={"xmlns": "http://www.opengis.net/kml/2.2"}).text = "0"
-            
-            image_index += 1                    
+        # shown initially.
+        for photo_index in range(image_index, photo_end_indices[i]):
+            write_photo_display(kml, photo_images_info[photo_index]["overlay_id"])
+        image_index = max(image_index, photo_end_indices[i])
 
         # Show the transparent png image that has the following details.
         # The name of the segment, distance travelled so far, current altitue and current time.
-        if i==0 or i%10 == 0:
-            text_image_file_name = os.path.join(folder, "text_img_" + str(i))
-            text_image_base_name = os.path.splitext(os.path.basename(text_image_file_name))[0]
-            text_image_overlay_id = f"image_{text_image_base_name}"
+        if show_text_image:
+            text_image_overlay_id = f"image_text_img_{i}"
 
             # first hide the previous text image overlay
             if previous_text_image_overlay_id != "":
-                animated_update_hide = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-                update_hide = ET.SubElement(animated_update_hide, "Update")
-                change_hide = ET.SubElement(update_hide, "Change")
-                screen_overlay_hide = ET.SubElement(change_hide, "ScreenOverlay", attrib={"targetId": previous_text_image_overlay_id})
-                ET.SubElement(screen_overlay_hide, "visibility", attrib={"xmlns": "http://www.opengis.net/kml/2.2"}).text = "0"
-                
-            animated_update_show = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-            update_show = ET.SubElement(animated_update_show, "Update")
-            change_show = ET.SubElement(update_show, "Change")
-            screen_overlay_show = ET.SubElement(change_show, "ScreenOverlay", attrib={"targetId": text_image_overlay_id})
-            ET.SubElement(screen_overlay_show, "visibility", attrib={"xmlns": "http://www.opengis.net/kml/2.2"}).text = "1"
+                write_screen_overlay_visibility(kml, previous_text_image_overlay_id, "0")
+
+            write_screen_overlay_visibility(kml, text_image_overlay_id, "1")
             previous_text_image_overlay_id = text_image_overlay_id
-            
+
         # Change camera position
-        if i%update_camera_frequency == 0:
-            flyto = ET.SubElement(playlist, 'gx:FlyTo')
-            ET.SubElement(flyto, 'gx:duration').text = '.3'
-            ET.SubElement(flyto, 'gx:flyToMode').text = 'smooth'
-            lookat = ET.SubElement(flyto, 'LookAt')
-            ET.SubElement(lookat, 'longitude').text = str(lon)
-            ET.SubElement(lookat, 'latitude').text = str(lat)
-            ET.SubElement(lookat, 'altitude').text = '0'
-            ET.SubElement(lookat, 'heading').text = str(bearing)
-            #ET.SubElement(lookat, 'heading').text = '0'
-            ET.SubElement(lookat, 'tilt').text = str(CAMERA_TILT_ANGLE)
-            #ET.SubElement(lookat, 'tilt').text = '0'
-            ET.SubElement(lookat, 'range').text = str(CAMERA_RANGE)
-            ET.SubElement(lookat, 'altitudeMode').text = 'relativeToGround'            		
-
-        # show the line segment
-        update = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-        # This duration doesn't seem to have any effect when the tour is played
-        # ET.SubElement(update, 'gx:duration').text = '5'
-        update_tag = ET.SubElement(update, 'Update')
-        ET.SubElement(update_tag, 'targetHref')
-        change = ET.SubElement(update_tag, 'Change')
-        placemark = ET.SubElement(change, 'Placemark', targetId=f'seg{i}')
-        #ET.SubElement(placemark, 'styleUrl').text = f'#{style_id}'  # Use the new style ID
-        ET.SubElement(placemark, 'visibility').text = '1'
-
-        # Change the position of the Hiker icon
-        animated_update_show = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-        update_show = ET.SubElement(animated_update_show, "Update")
-        ET.SubElement(update_show, 'targetHref')
-        change_show = ET.SubElement(update_show, "Change")
-        placemark_show = ET.SubElement(change_show, "Placemark", attrib={"targetId": "Hiker"})
-        point = ET.SubElement(placemark_show, 'Point')
-        ET.SubElement(point, 'coordinates').text = f"{lon},{lat},{elevation}"
-        ET.SubElement(placemark_show, "visibility").text = "1"
+        if move_camera:
+            kml.write(CAMERA_FLY_TO_TEMPLATE.format(longitude=lon, latitude=lat, heading=bearing))
+
+        # show the line segment and change the position of the Hiker icon.  Both are changed
+        # in the same update.  A gx:duration in this update doesn't seem to have any effect
+        # when the tour is played.
+        if show_segment:
+            kml.write(TRACK_STEP_TEMPLATE.format(index=i, coordinates=coordinates[i]))
 
         # Wait for a very short time.  Without this wait, the progressive line goes very, very fast
-        wait_element = ET.SubElement(playlist, "gx:Wait")
-        ET.SubElement(wait_element, "gx:duration").text = str(PAUSE_BETWEEN_LINE_SEGMENTS_IN_SECS)
+        pending_pauses += 1
 
         #
         # This is a hack to hide all way points on the ascent when the descent begins.
         # On the descent, we didnt stay in some of the places we stayed on the ascent
-        # and hence better not show them.
+        # and hence better not show them.  This is done only once, at the first
+        # trackpoint of the descent.
         #
-        if "descent".lower() in track_name.lower():
-            for i, waypoint in enumerate(gpx.waypoints):
-                if i<=11:
-                    animated_update_hide = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-                    update_hide = ET.SubElement(animated_update_hide, "Update")
-                    change_hide = ET.SubElement(update_hide, "Change")
-                    placemark_hide = ET.SubElement(change_hide, "Placemark", attrib={"targetId": f'waypoint{i}'})
-                    ET.SubElement(placemark_hide, "visibility").text = "0"
-                else:
-                    animated_update_show = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-                    update_show = ET.SubElement(animated_update_show, "Update")
-                    change_show = ET.SubElement(update_show, "Change")
-                    placemark_show = ET.SubElement(change_show, "Placemark", attrib={"targetId": f'waypoint{i}'})
-                    ET.SubElement(placemark_show, "visibility").text = "1"
+        if not descent_started and "descent" in track_name.lower():
+            descent_started = True
+            write_segment_pauses(kml, pending_pauses)
+            pending_pauses = 0
+            for wi in range(len(waypoints)):
+                write_placemark_visibility(kml, f'waypoint{wi}', "0" if wi<=11 else "1")
 
+    if pending_pauses:
+        write_segment_pauses(kml, pending_pauses)
 
     # Add images taken after the timestamp of the last trackpoint
     while image_index < len(photo_images_info):
-        img_base_name = os.path.splitext(os.path.basename(photo_images_info[image_index]["filename"]))[0]
-        overlay_id = f"image_{img_base_name}"
-                
-        animated_update_show = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-        update_show = ET.SubElement(animated_update_show, "Update")
-        change_show = ET.SubElement(update_show, "Change")
-        screen_overlay_show = ET.SubElement(change_show, "ScreenOverlay", attrib={"targetId": overlay_id})
-        ET.SubElement(screen_overlay_show, "visibility", attrib={"xmlns": "http://www.opengis.net/kml/2.2"}).text = "1"
-
-        wait_element = ET.SubElement(playlist, "gx:Wait")
-        ET.SubElement(wait_element, "gx:duration").text = str(PHOTO_DURATION_TIME_IN_SECS)
-
-        animated_update_hide = ET.SubElement(playlist, 'gx:AnimatedUpdate')
-        update_hide = ET.SubElement(animated_update_hide, "Update")
-        change_hide = ET.SubElement(update_hide, "Change")
-        screen_overlay_hide = ET.SubElement(change_hide, "ScreenOverlay", attrib={"targetId": overlay_id})
-        ET.SubElement(screen_overlay_hide, "visibility", attrib={"xmlns": "http://www.opengis.net/kml/2.2"}).text = "0"
-            
+        overlay_id = photo_images_info[image_index]["overlay_id"]
+
+        write_photo_display(kml, overlay_id)
+
         image_index += 1
- 
+
     #
     # This is to wait at the end of the tour so a recorded video doesnt end abruptly
     #
-    wait_element = ET.SubElement(playlist, "gx:Wait")
-    ET.SubElement(wait_element, "gx:duration").text = "3" 
-    
-    
-    
-    
-    
+    write_wait(kml, "3")
+
+
+#
+# Write the features of the kml document that are hidden initially and shown during the
+# tour - the overlays, the line segments, the styles and the placemarks.  Each feature is
+# written to the kml file as soon as it is created.
+#
+# segment_ends maps the index of the trackpoint where each line segment starts to the index
+# of the trackpoint where it ends.  Without simplification of the track, that is always the
+# next trackpoint.
+#
+# The text images are not rendered here.  Returns the list of the text images to render,
+# each as a tuple of the two lines of text and the file name of the image.
+#
+def write_document_features(kml, folder, title_exists, icon_exists, waypoints, points, segment_ends, cumulative_distances, photo_images_info):
     # Create image overlays (hidden initially - will be shown during the tour)
     for info in photo_images_info:
         image_overlay_element = create_photo_image_overlay_element(info)
-        document.append(image_overlay_element)
+        kml.write_element(image_overlay_element)
 
     # Create and append a overlay for the title
-    if os.path.exists(title_filepath):
+    if title_exists:
         title_overlay = create_title_overlay_element(folder)
-        document.append(title_overlay)
-    
-    total_distance = 0
-    text_image_files = []
+        kml.write_element(title_overlay)
     
-    # Add the line segments and the text images (hidden initially - will be shown during the tour)
-    # to the kml doc
-    for i in range(len(points) - 1):
-      
-        placemark = ET.SubElement(document, 'Placemark', id=f'seg{i}')
+    text_image_jobs = []
 
-        #ET.SubElement(placemark, 'styleUrl').text = '#yellowLine'
-        style_id = f'track_style_{points[i]["color"]}'  # Unique style ID
-        style = ET.SubElement(placemark, 'Style', id=style_id)
+    # Read the NumPy columns from lists in the loops below, like in write_tour_playlist.
+    # A missing elevation is 0.0 in the float column; show it as 0 like the waypoints.
+    elevations = [ele or 0 for ele in points["elevation"].tolist()]
+    colors, times, names, coordinates = points["color"], points["time"], points["name"], points["coordinates"]
+    cumulative_distances = cumulative_distances.tolist()
+    
+    #
+    # Add a style for the line segments of each track color.  Each segment refers to the style
+    # of its color instead of having a copy of the style inside it.
+    #
+    for color in dict.fromkeys(colors):
+        style_id = f'track_style_{color}'  # Unique style ID
+        style = ET.Element('Style', id=style_id)
         line_style = ET.SubElement(style, 'LineStyle')
-        ET.SubElement(line_style, 'color').text = 'ff' + str(points[i]["color"])  # KML color format is aabbggrr
+        ET.SubElement(line_style, 'color').text = 'ff' + str(color)  # KML color format is aabbggrr
         ET.SubElement(line_style, 'width').text = '6'
+        kml.write_element(style)
 
-        ET.SubElement(placemark, 'visibility').text = '0'
-        linestring = ET.SubElement(placemark, 'LineString')
-        ET.SubElement(linestring, 'tessellate').text = '1'
-        coords = f"{points[i]["longitude"]},{points[i]["latitude"]},{points[i]["elevation"]} {points[i+1]["longitude"]},{points[i+1]["latitude"]},{points[i+1]["elevation"]}"
-        ET.SubElement(linestring, 'coordinates').text = coords
+    # Add the line segments and the text images (hidden initially - will be shown during the tour)
+    # to the kml doc
+    for i in range(len(times) - 1):
+      
+        #
+        # The placemark is written from a template instead of building an element for it.
+        # Building elements for the thousands of segments took much longer.
+        #
+        if i in segment_ends:
+            kml.write(SEGMENT_PLACEMARK_TEMPLATE.format(index=i, color=escape_xml(colors[i]),
+                                                        coordinates=f"{coordinates[i]} {coordinates[segment_ends[i]]}"))
 
-        distance = calculate_distance(points[i]["latitude"], points[i]["longitude"], points[i+1]["latitude"], points[i+1]["longitude"])
-        total_distance += distance/1000
-        #print(f"count: {i} Distance between point {i} and {i+1}: {distance:.2f} meters")
+        # Distance covered so far including the current segment
+        total_distance = cumulative_distances[i+1]/1000
 
         #
         # Create transparent png images every 10 trackpoints that show the details of the current segment, the distance
         # covered so far, the current altitude and the time.
         #        
         if i==0 or i%10 == 0:
-            text_image_file_name = os.path.join(folder, "text_img_" + str(i) + ".png")
-            text_image_files.append(text_image_file_name)
+            text_image_file_name = os.path.join(folder, f"text_img_{i}.png")
         
-            time_str = convert_to_local_time_string(points[i]["time"])
+            time_str = convert_to_local_time_string(times[i].item())
             
             # A small hack to show the distance as 0km initially
             if (i==0):        
-                create_text_image_png(f"{points[i]["name"]}", f"0km    {points[i]["elevation"]}m    {time_str}", text_image_file_name)
+                text_image_jobs.append((f"{names[i]}", f"0km    {elevations[i]}m    {time_str}", text_image_file_name))
             else:
-                create_text_image_png(f"{points[i]["name"]}", f"{total_distance:0.2f}km    {points[i]["elevation"]}m    {time_str}", text_image_file_name)
+                text_image_jobs.append((f"{names[i]}", f"{total_distance:0.2f}km    {elevations[i]}m    {time_str}", text_image_file_name))
                 
-            text_image_base_name = os.path.splitext(os.path.basename(text_image_file_name))[0]
-            text_image_overlay_id = f"image_{text_image_base_name}"
+            text_image_overlay_id = f"image_text_img_{i}"
             text_image_overlay_element = create_text_image_overlay_element(text_image_file_name, text_image_overlay_id)
-            # text_image_overlays_elements.append(text_image_overlay_element)
-            document.append(text_image_overlay_element)
-
+            kml.write_element(text_image_overlay_element)
 
-    
 
     #
     # Add icons for waypoints as 'styles'.  And the waypoint placemarks are
@@ -841,15 +1063,12 @@ def create_kmz_from_gpx_and_photos(folder):
     # shown during the tour, the appropriate icon is displayed instead of just
     # a pin.
     #
-    icon_names = ["Hiker", "Heliport", "Hotel", "Restaurant", "Summit", "Bridge", "Airport"]
-    for icon_name in icon_names:
-        icon_image_filepath = os.path.join(folder, icon_name + ".png")
-        
-        style = ET.SubElement(document, 'Style', id=f"{icon_name}Style")
+    for icon_name in ICON_NAMES:
+        style = ET.Element('Style', id=f"{icon_name}Style")
         icon_style = ET.SubElement(style, 'IconStyle')
         icon = ET.SubElement(icon_style, 'Icon')
         
-        if os.path.exists(icon_image_filepath):
+        if icon_exists[icon_name]:
             ET.SubElement(icon, "href").text = icon_name + ".png"
             
         label_style = ET.SubElement(style, 'LabelStyle')
@@ -859,69 +1078,345 @@ def create_kmz_from_gpx_and_photos(folder):
         else:
             ET.SubElement(icon_style, 'scale').text = '4'
             ET.SubElement(label_style, 'scale').text = '2'
+        kml.write_element(style)
 
     #
     # Add a placemark for a hiker icon.  This is shown at the leading edge of the
     # progressive line.  Its position is updated regularly when the line extends.
     #
-    placemark = ET.SubElement(document, 'Placemark', id='Hiker')
+    placemark = ET.Element('Placemark', id='Hiker')
     #ET.SubElement(placemark, 'name').text = "Hiker"
     ET.SubElement(placemark, 'styleUrl').text = "#HikerStyle"
     point = ET.SubElement(placemark, 'Point')
-    ET.SubElement(point, 'coordinates').text = f"{points[0]["longitude"]},{points[0]["latitude"]},{points[0]["elevation"]}"  #lon,lat,ele
+    ET.SubElement(point, 'coordinates').text = coordinates[0]  #lon,lat,ele
     ET.SubElement(placemark, "visibility").text = "0"
+    kml.write_element(placemark)
      
     #     
     # Add the waypoints as placemarks with the appropriate style.
     #
-    for i, waypoint in enumerate(gpx.waypoints):
-        placemark = ET.SubElement(document, 'Placemark', id=f'waypoint{i}')
-        ET.SubElement(placemark, 'name').text = waypoint.name if waypoint.name else "Waypoint"
+    for i, waypoint in enumerate(waypoints):
+        placemark = ET.Element('Placemark', id=f'waypoint{i}')
+        ET.SubElement(placemark, 'name').text = waypoint["name"] if waypoint["name"] else "Waypoint"
         point = ET.SubElement(placemark, 'Point')
-        ET.SubElement(point, 'coordinates').text = f"{waypoint.longitude},{waypoint.latitude},{waypoint.elevation or 0}"  #lon,lat,ele
+        ET.SubElement(point, 'coordinates').text = f"{waypoint["longitude"]},{waypoint["latitude"]},{waypoint["elevation"] or 0}"  #lon,lat,ele
 
-        if waypoint.description:
-            ET.SubElement(placemark, 'description').text = waypoint.description   
+        if waypoint["description"]:
+            ET.SubElement(placemark, 'description').text = waypoint["description"]   
             
-        ET.SubElement(placemark, 'styleUrl').text = f"#{waypoint.symbol}Style"
+        ET.SubElement(placemark, 'styleUrl').text = f"#{waypoint["symbol"]}Style"
         ET.SubElement(placemark, "visibility").text = "0"
-    
-    
-    
-    # Create the KML file
-    tree = ET.ElementTree(doc)
-    ET.indent(tree, space="  ", level=0)
-    kml_output = os.path.join(folder, gpx_file_name + ".kml")
-    #print(f"kml_output: {kml_output} tree: {tree}")
-    tree.write(kml_output, encoding='utf-8', xml_declaration=True)
+        kml.write_element(placemark)
+
+    return text_image_jobs
+
+
+#
+# Reads the trackpoints and waypoints from the gpx file.
+#
+# The file is parsed incrementally with iterparse instead of building a tree for the
+# whole file.  Each trackpoint is read when its end tag is parsed and then removed
+# from the tree, so the memory used doesn't grow with the number of trackpoints.
+#
+# The tags are matched in any namespace so that both GPX 1.0 and 1.1 files work.
+#
+# Snippet of the track name and color in a gpx track
+#   <trk>
+#     <name>EBC Trek, day 1 - Lukla to Phakding</name>
+#     <extensions>
+#       <gpx_style:line>
+#         <gpx_style:color>E834EC</gpx_style:color>
+#       </gpx_style:line>
+#     </extensions>
+#     <trkseg>
+#       <trkpt lat="27.687622" lon="86.729066">
+#       ...
+#
+def read_gpx_file(gpx_filepath):
+    """
+    Reads the trackpoints and waypoints from a gpx file.
+
+    Args:
+        gpx_filepath: Path of the gpx file.
+
+    Returns:
+        A tuple (points, waypoints).  points is a dict of columns - "longitude",
+        "latitude" and "elevation" as float64 arrays, "time" as a datetime64[us]
+        array in UTC and "color" and "name" as lists with one entry per trackpoint.
+        waypoints is a list of dicts with "name", "description", "symbol",
+        "longitude", "latitude" and "elevation".
+    """
+    default_color = 'FFFFFFFF'  # White 
+
+    # The numeric columns are collected in compact typed arrays instead of lists of
+    # float and datetime objects.  Times are microseconds since the epoch.
+    longitudes, latitudes, elevations = array('d'), array('d'), array('d')
+    times = array('q')
+    colors, names = [], []
+    waypoints = []
 
+    track_name = None
+    track_color = None
+
+    for event, elem in ET.iterparse(gpx_filepath, events=('start', 'end'),
+                                    tag=('{*}trk', '{*}name', '{*}color', '{*}trkpt', '{*}wpt')):
+        tag = ET.QName(elem).localname
+
+        if tag == 'trk':
+            if event == 'start':
+                track_name = None
+                track_color = None
+            else:
+                elem.clear()
+            continue
+
+        if event == 'start':
+            continue
+
+        parent = elem.getparent()
+
+        if tag == 'name':
+            # Only the name of a track.  Names of waypoints are read with the waypoint.
+            if ET.QName(parent).localname == 'trk':
+                track_name = elem.text
+
+        elif tag == 'color':
+            # Get color from the <line> extension of the track.  Handles missing color.
+            extensions = parent.getparent()
+            if (track_color is None and elem.text and parent.tag.endswith('line') and
+                    extensions is not None and ET.QName(extensions.getparent()).localname == 'trk'):
+                track_color = elem.text
+
+        elif tag == 'trkpt':
+            # xsd:dateTime and xsd:decimal allow whitespace around the value
+            ele = (elem.findtext('{*}ele') or '').strip()
+            time = (elem.findtext('{*}time') or '').strip()
+            longitudes.append(float(elem.get('lon')))
+            latitudes.append(float(elem.get('lat')))
+            elevations.append(float(ele) if ele else 0)
+            colors.append(track_color or default_color)
+            times.append(to_epoch_microseconds(datetime.datetime.fromisoformat(time)) if time else NOT_A_TIME)
+            names.append(track_name)
+
+            # Free the trackpoints that have been read
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+        elif tag == 'wpt':
+            ele = (elem.findtext('{*}ele') or '').strip()
+            waypoints.append({
+                "name": elem.findtext('{*}name'),
+                "description": elem.findtext('{*}desc'),
+                "symbol": elem.findtext('{*}sym'),
+                "longitude": float(elem.get('lon')),
+                "latitude": float(elem.get('lat')),
+                "elevation": float(ele) if ele else None,
+            })
+            elem.clear()
+
+    points = {
+        "longitude": np.frombuffer(longitudes, dtype=np.float64),
+        "latitude": np.frombuffer(latitudes, dtype=np.float64),
+        "elevation": np.frombuffer(elevations, dtype=np.float64),
+        "color": colors,
+        "time": np.frombuffer(times, dtype=np.int64).view('datetime64[us]'),
+        "name": names,
+    }
+
+    return points, waypoints
+
+
+#
+# The main function of the script
+#        
+def create_kmz_from_gpx_and_photos(folder):
+
+    #
+    # Find the gpx file in the folder.  There should be only one gpx file.  Even if there are other gpx
+    # files, they will be ignored.
+    #
+    gpx_file_name = None
+    for file in os.listdir(folder):
+        # print(f"folder: {folder} file: {file}")
+        if file.lower().endswith('.gpx'):
+            gpx_file_name = file
+            break
+                
+    if gpx_file_name is None:
+        print("No GPX file found in folder")
+        return
+
+    gpx_filepath = os.path.join(folder, gpx_file_name)
+    print(f"Found gpx file: {gpx_filepath}.  Converting it to kml and embedding photos and track details inside it...")
+
+    photo_images_info = get_info_of_all_images_files(folder)
+
+    #for info in photo_images_info:
+    #    print(f'filename: {info["filename"]}')
+
+      
+    #
+    # Get the points data from the GPX file into points variable.  The points are stored
+    # as columns - one array or list per field - instead of one dict per trackpoint.
+    #
+    points, waypoints = read_gpx_file(gpx_filepath)
+
+    if len(points["time"]) < 2:
+        return  # Skip if not enough points to form a line
+
+    #
+    # Calculate the distance from the start of the track to each trackpoint in one go
+    # instead of one segment at a time.  The coordinates are converted to radians only once
+    # for both the distances and the bearings.
+    #
+    lats_rad = np.radians(points["latitude"])
+    lons_rad = np.radians(points["longitude"])
+    segment_distances = calculate_segment_distances(lats_rad, lons_rad)
+    cumulative_distances = np.concatenate(([0], np.cumsum(segment_distances)))
+
+    # Bearings used to point the camera along the track
+    bearings = calculate_bearings(lats_rad, lons_rad, 50)
+
+    #
+    # Simplify the line of the track so that the tour doesn't have a line segment for every few
+    # metres.  Only the line segments are drawn between the kept trackpoints.  Everything else
+    # in the tour still uses all the trackpoints.  The first trackpoint of each track is always
+    # kept so that the colors of the line change at the same places.
+    #
+    segment_point_indices = list(range(len(points["time"])))
+    if TRACK_SIMPLIFICATION_TOLERANCE_IN_METRES > 0:
+        names, colors = points["name"], points["color"]
+        track_starts = [i for i in range(1, len(names)) if names[i] != names[i-1] or colors[i] != colors[i-1]]
+        segment_point_indices = simplify_track(lats_rad, lons_rad, TRACK_SIMPLIFICATION_TOLERANCE_IN_METRES, track_starts).tolist()
+
+        print(f"Simplified the track from {len(names)} to {len(segment_point_indices)} trackpoints.")
+
+    # The trackpoint where each line segment ends, by the trackpoint where it starts
+    segment_ends = dict(zip(segment_point_indices[:-1], segment_point_indices[1:]))
+
+    #
+    # Format the coordinates of each trackpoint only once.  They are used both for the line
+    # segments on either side of the trackpoint and for moving the Hiker icon to it.  A missing
+    # elevation is written as 0, not 0.0, like for the waypoints.
+    #
+    points["coordinates"] = [f"{lon},{lat},{ele or 0}" for lon, lat, ele in
+                             zip(points["longitude"].tolist(), points["latitude"].tolist(), points["elevation"].tolist())]
+
+
+    #
+    # Check only once which of the title and the icon images are in the folder.  This is
+    # needed both for the kml document and for the KMZ.
+    #
+    title_filepath = os.path.join(folder, "Title.png")
+    title_exists = os.path.exists(title_filepath)
+    icon_filepaths = {icon_name: os.path.join(folder, icon_name + ".png") for icon_name in ICON_NAMES}
+    icon_exists = {icon_name: os.path.exists(filepath) for icon_name, filepath in icon_filepaths.items()}
 
     # Create the KMZ
     output_kmz_path = os.path.join(folder, "combined.kmz")
     print(f"Combining the KML file along with the images and creating KMZ file - {output_kmz_path}...")
 
-   
-    with zipfile.ZipFile(output_kmz_path, 'w', zipfile.ZIP_DEFLATED) as kmz_file:
-        kmz_file.write(kml_output, gpx_file_name + ".kml")
-        
-        if os.path.exists(title_filepath):
-            kmz_file.write(title_filepath, "Title.png")
-        else:
-            print(f"Title image file {title_filepath} doesn't exist.")
+    #
+    # The KMZ file is written to a temporary file first and only replaces combined.kmz once it
+    # is complete.  If anything fails while it is written, for example rendering a text image,
+    # the previous combined.kmz is kept instead of being replaced by an incomplete one.
+    #
+    temp_kmz_path = output_kmz_path + ".tmp"
+    try:
+        with zipfile.ZipFile(temp_kmz_path, 'w', zipfile.ZIP_DEFLATED) as kmz_file:
+            #
+            # Write the kml document straight into the KMZ file.  It is compressed as it is
+            # written, so neither a separate kml file nor the whole document in memory is needed.
+            #
+            with kmz_file.open(gpx_file_name + ".kml", 'w') as kml_file:
+                kml = KmlWriter(kml_file)
+                kml.write("<?xml version='1.0' encoding='utf-8'?>\n")
+                kml.write(f'<kml xmlns="{KML_NAMESPACE}" xmlns:gx="{GX_NAMESPACE}"><Document><name>{escape_xml(gpx_file_name)}</name>')
+
+                # gx:Tour
+                kml.write('<gx:Tour><name>Animated tour</name><gx:Playlist>')
+                write_tour_playlist(kml, title_exists, waypoints, points, segment_ends, bearings, photo_images_info)
+                kml.write('</gx:Playlist></gx:Tour>')
+
+                text_image_jobs = write_document_features(kml, folder, title_exists, icon_exists, waypoints, points, segment_ends, cumulative_distances, photo_images_info)
+
+                kml.write('</Document></kml>')
+                kml.flush()
+
+            #
+            # Render the text images.  They don't depend on each other, so they are rendered in
+            # parallel in a pool of processes, like the photos are processed.  Each process loads
+            # the font itself when it renders its first text image.
+            #
+            text_lines1, text_lines2, text_image_files = zip(*text_image_jobs)
+            with ProcessPoolExecutor() as executor:
+                list(executor.map(create_text_image_png, text_lines1, text_lines2, text_image_files, chunksize=16))
+
+            #
+            # List the image files to put in the KMZ file, each with its name in the KMZ file, how
+            # it is compressed and the compression level.
+            # - The title is deflated like the kml file.
+            # - The photos are jpegs which are already compressed.  Deflating them again costs a lot
+            #   of CPU for almost no reduction in size, so store them as they are.
+            # - The text images are saved with the fastest png compression and still get about 25%
+            #   smaller when deflated.  The fastest deflate level shrinks them as much as the
+            #   default level.
+            # - The icons are small, fully compressed pngs that hardly shrink when deflated, so
+            #   store them as they are like the photos.
+            #
+            kmz_entries = []
+
+            if title_exists:
+                kmz_entries.append((title_filepath, "Title.png", zipfile.ZIP_DEFLATED, None))
+            else:
+                print(f"Title image file {title_filepath} doesn't exist.")
         
-        for info in photo_images_info:
-            #print(f"Including {os.path.basename(info["filepath"])} inside KMZ file...")
-            kmz_file.write(info["filepath"], os.path.basename(info["filepath"]))
+            for info in photo_images_info:
+                #print(f"Including {os.path.basename(info["filepath"])} inside KMZ file...")
+                kmz_entries.append((info["filepath"], os.path.basename(info["filepath"]), zipfile.ZIP_STORED, None))
             
-        for img_file in text_image_files:
-            kmz_file.write(img_file, os.path.basename(img_file))
+            for img_file in text_image_files:
+                kmz_entries.append((img_file, os.path.basename(img_file), zipfile.ZIP_DEFLATED, 1))
             
-        for icon_name in icon_names:
-            icon_image_filepath = os.path.join(folder, icon_name + ".png")
-            if os.path.exists(icon_image_filepath):
-                kmz_file.write(icon_image_filepath, os.path.basename(icon_image_filepath))
-            else:
-                print(f"Icon image file {icon_image_filepath} doesn't exist.")
+            for icon_name, icon_image_filepath in icon_filepaths.items():
+                if icon_exists[icon_name]:
+                    kmz_entries.append((icon_image_filepath, os.path.basename(icon_image_filepath), zipfile.ZIP_STORED, None))
+                else:
+                    print(f"Icon image file {icon_image_filepath} doesn't exist.")
+
+            #
+            # The files that are stored are copied into the KMZ file in blocks of 1MB.  ZipFile.write()
+            # copies them in blocks of only 8KB, which takes many more reads and writes for the photos
+            # of several MB each.
+            #
+            for filepath, arcname, compress_type, compresslevel in kmz_entries:
+                if compress_type == zipfile.ZIP_STORED:
+                    zinfo = zipfile.ZipInfo.from_file(filepath, arcname)
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                    with open(filepath, 'rb') as src, kmz_file.open(zinfo, 'w') as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                else:
+                    kmz_file.write(filepath, arcname, compress_type=compress_type, compresslevel=compresslevel)
+    except BaseException:
+        # Don't leave the incomplete KMZ file in the folder
+        if os.path.exists(temp_kmz_path):
+            os.remove(temp_kmz_path)
+        raise
+
+    os.replace(temp_kmz_path, output_kmz_path)
+
+    #
+    # Save an indented copy of the kml file for troubleshooting.  This reads the kml file
+    # back from the KMZ file, so it doesn't slow down writing the KMZ when it is not needed.
+    #
+    if SAVE_INDENTED_KML_COPY:
+        indented_kml_path = os.path.join(folder, gpx_file_name + ".kml")
+        print(f"Saving an indented copy of the kml file - {indented_kml_path}...")
+        with zipfile.ZipFile(output_kmz_path) as kmz_file:
+            with kmz_file.open(gpx_file_name + ".kml") as kml_file:
+                tree = ET.parse(kml_file)
+        tree.write(indented_kml_path, encoding='utf-8', xml_declaration=True, pretty_print=True)
             
     
     